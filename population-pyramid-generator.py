@@ -1,72 +1,158 @@
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
 import io
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import numpy as np
 
+# On-disk cache of parsed workbooks, reused across app restarts
+CACHE_DIR = Path(__file__).parent / ".cache" / "pyramids"
+# Bump whenever the stored columns or dtypes change so older cache files are ignored
+CACHE_VERSION = 2
+
 st.set_page_config(page_title="Population Pyramid Generator", layout="wide")
 
 st.title("🌍 Population Pyramid Generator")
 st.markdown("Upload male and female population data to create custom population pyramids")
 
 # Initialize session state
-if 'male_df' not in st.session_state:
-    st.session_state.male_df = None
-if 'female_df' not in st.session_state:
-    st.session_state.female_df = None
 if 'age_cols' not in st.session_state:
     st.session_state.age_cols = None
 if 'countries' not in st.session_state:
     st.session_state.countries = []
 if 'years' not in st.session_state:
     st.session_state.years = []
+if 'male_age_mat' not in st.session_state:
+    st.session_state.male_age_mat = None
+if 'female_age_mat' not in st.session_state:
+    st.session_state.female_age_mat = None
+if 'male_row_index' not in st.session_state:
+    st.session_state.male_row_index = {}
+if 'female_row_index' not in st.session_state:
+    st.session_state.female_row_index = {}
+if 'data_id' not in st.session_state:
+    st.session_state.data_id = None
 if 'generated_pyramids' not in st.session_state:
     st.session_state.generated_pyramids = []
-if 'pyramid_selections' not in st.session_state:
-    st.session_state.pyramid_selections = []
 
 
-def load_population_data(file_path, header_row=16):
-    """Load and clean population data from uploaded Excel file."""
-    df = pd.read_excel(file_path, skiprows=header_row)
+def write_atomically(path, write):
+    """Call write() on a temporary file next to path, then move it into place in one step.
+    
+    Concurrent sessions writing the same cache entry never leave a half-written file behind.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+@st.cache_data(show_spinner=False, max_entries=4)  # Parsed data is also kept on disk
+def load_population_data(file_bytes, header_row=16):
+    """Load and clean population data from uploaded Excel file bytes (cached across reruns)."""
+    # Reuse a previously parsed copy of the same workbook if one exists on disk
+    key = f"v{CACHE_VERSION}_{hashlib.md5(file_bytes).hexdigest()}_{header_row}"
+    parquet_path = CACHE_DIR / f"{key}.parquet"
+    age_cols_path = CACHE_DIR / f"{key}.json"
+    if parquet_path.exists() and age_cols_path.exists():
+        try:
+            df = pd.read_parquet(parquet_path)
+            age_cols = json.loads(age_cols_path.read_text())
+            return df, age_cols
+        except Exception:
+            # Drop unreadable cache files and parse the workbook again
+            parquet_path.unlink(missing_ok=True)
+            age_cols_path.unlink(missing_ok=True)
+    
+    source = io.BytesIO(file_bytes)
+    
+    # Read the header row only to find which columns we actually need
+    header = pd.read_excel(source, skiprows=header_row, nrows=0, engine="calamine")
+    columns = header.columns.astype(str).str.strip()
+    
+    # Detect age group columns ("0-4", "5-9", ..., "100+")
+    age_cols = columns[columns.str.match(r'^(\d+(-\d+)?|100\+?)$')].tolist()
+    
+    # Fail early on an unexpected header instead of letting usecols drop the columns silently
+    missing = [c for c in ["Region, subregion, country or area *", "Year"] if c not in columns]
+    if not age_cols:
+        missing.append("age group columns (0-4, 5-9, ...)")
+    if missing:
+        raise ValueError(f"Expected columns not found in header row {header_row + 1}: {', '.join(missing)}")
+    
+    # Parse only the country, year and age group columns (by position)
+    keep = ["Region, subregion, country or area *", "Year", *age_cols]
+    usecols = np.flatnonzero(columns.isin(keep)).tolist()
+    
+    source.seek(0)
+    df = pd.read_excel(source, skiprows=header_row, usecols=usecols, engine="calamine")
     df.columns = df.columns.astype(str).str.strip()
     
-    # Detect age group columns
-    age_cols = [c for c in df.columns if c.split('-')[0].isdigit() or c.startswith('100')]
+    # Store ages as numbers (non-numeric markers become NaN) and countries as categories
+    df[age_cols] = df[age_cols].apply(pd.to_numeric, errors='coerce')
+    df["Region, subregion, country or area *"] = df["Region, subregion, country or area *"].astype("category")
+    
+    # Persist the parsed data so the next cold start skips Excel parsing
+    # (the JSON goes last, a cache entry only counts once both files exist)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        write_atomically(parquet_path, lambda path: df.to_parquet(path, compression="zstd"))
+        write_atomically(age_cols_path, lambda path: Path(path).write_text(json.dumps(age_cols)))
+    except Exception:
+        # Disk cache is best-effort only
+        parquet_path.unlink(missing_ok=True)
+        age_cols_path.unlink(missing_ok=True)
     
     return df, age_cols
 
 
+def build_age_matrix(df, age_cols):
+    """Convert age group columns to a float64 matrix and a (country, year) -> row lookup."""
+    age_mat = df[age_cols].fillna(0).to_numpy(dtype=np.float64)
+    
+    row_index = {}
+    for i, key in enumerate(zip(df["Region, subregion, country or area *"], df["Year"])):
+        # Keep the first row for duplicated country/year pairs
+        row_index.setdefault(key, i)
+    
+    return age_mat, row_index
+
+
 def create_population_pyramid(male_data, female_data, age_groups, country, year, interactive=False):
-    """Create a population pyramid for given country and year."""
-    fig, ax = plt.subplots(figsize=(12, 8))
+    """Create a population pyramid for given country and year.
     
-    # Prepare data (keep original values in thousands)
-    y_pos = np.arange(len(age_groups))
+    Returns a (preview_png, full_png) pair: a low-resolution image for the grid preview
+    and a high-resolution one for the full view and download.
+    """
+    # Use the object-oriented API only, pyplot state is not thread-safe
+    fig = Figure(figsize=(12, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
     
-    # Male data (negative for left side, already in thousands)
-    male_values = -male_data.values / 1000  # Convert to thousands and make negative
-    female_values = female_data.values / 1000  # Convert to thousands
+    # Prepare data (values already in thousands)
+    y_pos = np.arange(len(age_groups))
     
-    # Create horizontal bars
-    bars_male = ax.barh(y_pos, male_values, height=0.8, label='Male', color='#3498db', alpha=0.8)
-    bars_female = ax.barh(y_pos, female_values, height=0.8, label='Female', color='#e74c3c', alpha=0.8)
+    # Create horizontal bars (male data negated for the left side)
+    bars_male = ax.barh(y_pos, -male_data, height=0.8, label='Male', color='#3498db', alpha=0.8)
+    bars_female = ax.barh(y_pos, female_data, height=0.8, label='Female', color='#e74c3c', alpha=0.8)
     
     # Add value labels on bars if interactive mode
     if interactive:
-        for i, (bar_m, bar_f) in enumerate(zip(bars_male, bars_female)):
-            # Male labels (on left side)
-            male_val = abs(male_values[i])
-            if male_val > 0:
-                ax.text(male_values[i] * 0.5, i, 
-                       f'{male_val:.1f}k', ha='center', va='center', fontsize=7, color='white', fontweight='bold')
-            
-            # Female labels (on right side)
-            female_val = female_values[i]
-            if female_val > 0:
-                ax.text(female_values[i] * 0.5, i, 
-                       f'{female_val:.1f}k', ha='center', va='center', fontsize=7, color='white', fontweight='bold')
+        # Male labels (on left side) and female labels (on right side), centered in each bar
+        ax.bar_label(bars_male, labels=[f'{v:.1f}k' if v > 0 else '' for v in male_data],
+                     label_type='center', fontsize=7, color='white', fontweight='bold')
+        ax.bar_label(bars_female, labels=[f'{v:.1f}k' if v > 0 else '' for v in female_data],
+                     label_type='center', fontsize=7, color='white', fontweight='bold')
     
     # Customize plot
     ax.set_yticks(y_pos)
@@ -76,7 +162,7 @@ def create_population_pyramid(male_data, female_data, age_groups, country, year,
     ax.set_title(f'Population Pyramid: {country} ({year})', fontsize=16, fontweight='bold', pad=20)
     
     # Format x-axis to show absolute values with proper scale
-    max_val = max(abs(male_values.min()), female_values.max())
+    max_val = max(male_data.max(), female_data.max())
     ax.set_xlim(-max_val * 1.15, max_val * 1.15)
     
     # Custom x-axis labels (absolute values in thousands)
@@ -91,40 +177,57 @@ def create_population_pyramid(male_data, female_data, age_groups, country, year,
     ax.axvline(x=0, color='black', linewidth=1.2)
     
     # Add total population annotation
-    total_male = abs(male_values.sum())
-    total_female = female_values.sum()
+    total_male = male_data.sum()
+    total_female = female_data.sum()
     total_pop = total_male + total_female
-    ax.text(0.02, 0.98, f'Total: {total_pop:.1f}k\nMale: {total_male:.1f}k\nFemale: {total_female:.1f}million',
+    ax.text(0.02, 0.98, f'Total: {total_pop:.1f}k\nMale: {total_male:.1f}k\nFemale: {total_female:.1f}k',
             transform=ax.transAxes, fontsize=10, verticalalignment='top',
             bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.5))
     
-    plt.tight_layout()
-    return fig
+    fig.tight_layout()
+    preview_png = fig_to_bytes(fig, dpi=72)
+    return preview_png, fig_to_bytes(fig, dpi=150)
 
 
-def create_data_table(male_data, female_data, age_groups, country, year):
-    """Create a summary table for the population data."""
-    # Convert to numeric and handle any non-numeric values
-    male_vals = pd.to_numeric(male_data, errors='coerce').fillna(0).values
-    female_vals = pd.to_numeric(female_data, errors='coerce').fillna(0).values
+@st.cache_data(show_spinner=False, max_entries=300)  # ~200 KB of PNGs per entry
+def render_pyramid_png(country, year, interactive, data_id, _male_data, _female_data, _age_groups):
+    """Render a pyramid's preview and full-size PNGs, cached per country, year, options and uploaded data.
     
-    df = pd.DataFrame({
+    Arguments starting with an underscore are not hashed; data_id stands in for them.
+    """
+    return create_population_pyramid(_male_data, _female_data, _age_groups, country, year, interactive=interactive)
+
+
+def create_data_table(male_vals, female_vals, age_groups):
+    """Create a summary table for the population data from the precomputed rows."""
+    return pd.DataFrame({
         'Age Group': age_groups,
         'Male': male_vals,
         'Female': female_vals,
         'Total': male_vals + female_vals
     })
-    return df
 
 
-def fig_to_bytes(fig):
+def fig_to_bytes(fig, dpi=150):
     """Convert matplotlib figure to PNG bytes."""
     buf = io.BytesIO()
-    fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
+    fig.savefig(buf, format='png', dpi=dpi)
     buf.seek(0)
     return buf.getvalue()
 
 
+@st.cache_resource(show_spinner=False)
+def warm_up_matplotlib():
+    """Render a throwaway figure once per process so the first pyramid doesn't pay for font loading."""
+    fig = Figure(figsize=(1, 1))
+    FigureCanvasAgg(fig)
+    fig.text(0.5, 0.5, 'warm-up', fontsize=10, fontweight='bold')
+    fig.canvas.draw()
+
+
+warm_up_matplotlib()
+
+
 # === FILE UPLOAD SECTION ===
 st.header("📁 Step 1: Upload Data Files")
 
@@ -139,25 +242,38 @@ with col2:
 # Process uploaded files
 if male_file and female_file:
     # Only process if not already loaded
-    if st.session_state.male_df is None or st.session_state.female_df is None:
+    if st.session_state.male_age_mat is None or st.session_state.female_age_mat is None:
         try:
             with st.spinner("Loading data..."):
-                male_df, male_age_cols = load_population_data(male_file, header_row=16)
-                female_df, female_age_cols = load_population_data(female_file, header_row=16)
+                male_bytes = male_file.getvalue()
+                female_bytes = female_file.getvalue()
+                male_df, male_age_cols = load_population_data(male_bytes, header_row=16)
+                female_df, female_age_cols = load_population_data(female_bytes, header_row=16)
                 
-                # Store in session state
-                st.session_state.male_df = male_df
-                st.session_state.female_df = female_df
+                # Store in session state (only the age matrices are kept, not the DataFrames)
                 st.session_state.age_cols = male_age_cols
                 
-                # Get common countries and years
-                male_countries = set(male_df["Region, subregion, country or area *"])
-                female_countries = set(female_df["Region, subregion, country or area *"])
-                common_countries = sorted(list(male_countries & female_countries))
+                # Identify the uploaded data so cached pyramid images are tied to it
+                data_hash = hashlib.md5(male_bytes)
+                data_hash.update(female_bytes)
+                st.session_state.data_id = data_hash.hexdigest()
                 
-                years_male = set(male_df["Year"])
-                years_female = set(female_df["Year"])
-                common_years = sorted(list(years_male & years_female))
+                # Precompute numeric age group matrices once instead of on every generate click
+                st.session_state.male_age_mat, st.session_state.male_row_index = build_age_matrix(male_df, male_age_cols)
+                st.session_state.female_age_mat, st.session_state.female_row_index = build_age_matrix(female_df, male_age_cols)
+                
+                # Get common countries and years without building Python sets
+                common_countries = (
+                    pd.Index(male_df["Region, subregion, country or area *"].dropna().unique())
+                    .intersection(female_df["Region, subregion, country or area *"].dropna().unique())
+                    .sort_values().tolist()
+                )
+                
+                common_years = (
+                    pd.Index(male_df["Year"].dropna().unique())
+                    .intersection(female_df["Year"].dropna().unique())
+                    .sort_values().tolist()
+                )
                 
                 st.session_state.countries = common_countries
                 st.session_state.years = common_years
@@ -168,40 +284,32 @@ if male_file and female_file:
             st.error(f"❌ Error loading files: {str(e)}")
 
 # === PYRAMID CONFIGURATION SECTION ===
-if st.session_state.male_df is not None and st.session_state.female_df is not None:
+if st.session_state.male_age_mat is not None and st.session_state.female_age_mat is not None:
     st.header("📊 Step 2: Configure Population Pyramids")
     st.markdown("Select up to 6 country/year combinations to generate pyramids")
     
     # Number of pyramids selector
     num_pyramids = st.number_input("Number of pyramids to generate", min_value=1, max_value=6, value=1, step=1)
     
-    # Store selections temporarily (no data processing)
-    st.session_state.pyramid_selections = []
-    
+    # Selections live in widget state and are only read when generating
     cols = st.columns(min(3, num_pyramids))
     for i in range(num_pyramids):
         with cols[i % 3]:
             st.subheader(f"Pyramid {i+1}")
             
             # Simple selection without processing
-            country = st.selectbox(
+            st.selectbox(
                 "Country",
                 options=st.session_state.countries,
                 key=f"country_{i}",
                 help="Start typing to search"
             )
             
-            year = st.selectbox(
+            st.selectbox(
                 "Year",
                 options=st.session_state.years,
                 key=f"year_{i}"
             )
-            
-            # Store selection (no data lookup, just store the values)
-            st.session_state.pyramid_selections.append({
-                'country': country,
-                'year': year
-            })
     
     # Display options
     st.subheader("Display Options")
@@ -214,59 +322,76 @@ if st.session_state.male_df is not None and st.session_state.female_df is not No
     # === GENERATE PYRAMIDS ===
     if st.button("🎨 Generate Pyramids", type="primary", use_container_width=True):
         with st.spinner(f"Generating {num_pyramids} pyramids..."):
-            st.session_state.generated_pyramids = []
+            generated_pyramids = st.session_state.generated_pyramids = []
             
             progress_bar = st.progress(0)
             
-            for idx, selection in enumerate(st.session_state.pyramid_selections):
-                country = selection['country']
-                year = selection['year']
-                
-                # Update progress
-                progress_bar.progress((idx + 1) / len(st.session_state.pyramid_selections))
-                
-                # Get data for selected country and year
-                male_row = st.session_state.male_df[
-                    (st.session_state.male_df["Region, subregion, country or area *"] == country) & 
-                    (st.session_state.male_df["Year"] == year)
-                ]
-                
-                female_row = st.session_state.female_df[
-                    (st.session_state.female_df["Region, subregion, country or area *"] == country) & 
-                    (st.session_state.female_df["Year"] == year)
-                ]
-                
-                if not male_row.empty and not female_row.empty:
-                    male_data = male_row[st.session_state.age_cols].iloc[0]
-                    female_data = female_row[st.session_state.age_cols].iloc[0]
-                    
-                    # Create pyramid
-                    fig = create_population_pyramid(
-                        male_data, 
-                        female_data, 
-                        st.session_state.age_cols, 
-                        country, 
+            keys = [(st.session_state[f'country_{i}'], st.session_state[f'year_{i}']) for i in range(num_pyramids)]
+            
+            # Local aliases, so the loops below don't go through session state on every access
+            male_age_mat = st.session_state.male_age_mat
+            female_age_mat = st.session_state.female_age_mat
+            male_row_index = st.session_state.male_row_index
+            female_row_index = st.session_state.female_row_index
+            age_cols = st.session_state.age_cols
+            data_id = st.session_state.data_id
+            
+            # Get data for each distinct country and year straight from the precomputed matrices
+            found_keys = []
+            for country, year in dict.fromkeys(keys):
+                if (country, year) in male_row_index and (country, year) in female_row_index:
+                    found_keys.append((country, year))
+                else:
+                    st.warning(f"⚠️ No data found for {country}, {year}")
+            
+            # Gather all rows in one indexing pass per matrix before any rendering starts
+            male_rows = [male_row_index[k] for k in found_keys]
+            female_rows = [female_row_index[k] for k in found_keys]
+            male_batch = male_age_mat[male_rows]
+            female_batch = female_age_mat[female_rows]
+            
+            # Plots are drawn in thousands, tables keep the source values
+            pyramid_data = {key: (male_batch[i] / 1000.0, female_batch[i] / 1000.0) for i, key in enumerate(found_keys)}
+            
+            # Render each distinct pyramid to PNG once, in parallel (Agg releases the GIL while rasterizing)
+            png_results = {}
+            with ThreadPoolExecutor(max_workers=min(6, os.cpu_count() or 1)) as pool:
+                futures = {
+                    pool.submit(
+                        render_pyramid_png,
+                        country,
                         year,
-                        interactive=show_values
-                    )
-                    
-                    # Create data table
-                    data_table = create_data_table(
+                        show_values,
+                        data_id,
                         male_data,
                         female_data,
-                        st.session_state.age_cols,
-                        country,
-                        year
-                    )
+                        age_cols
+                    ): (country, year)
+                    for (country, year), (male_data, female_data) in pyramid_data.items()
+                }
+                for done, future in enumerate(as_completed(futures), start=1):
+                    png_results[futures[future]] = future.result()
                     
-                    st.session_state.generated_pyramids.append({
-                        'fig': fig,
+                    # Update progress
+                    progress_bar.progress(done / len(futures))
+            
+            # Create data tables
+            data_tables = {
+                key: create_data_table(male_batch[i], female_batch[i], age_cols)
+                for i, key in enumerate(found_keys)
+            }
+            
+            # Keep pyramids in the order they were selected, repeated selections included
+            for country, year in keys:
+                if (country, year) in pyramid_data:
+                    preview_png, png = png_results[(country, year)]
+                    generated_pyramids.append({
+                        'preview_png': preview_png,
+                        'png': png,
                         'country': country,
                         'year': year,
-                        'table': data_table
+                        'table': data_tables[(country, year)]
                     })
-                else:
-                    st.warning(f"⚠️ No data found for {country}, {year}")
             
             progress_bar.empty()
         
@@ -279,6 +404,9 @@ if st.session_state.male_df is not None and st.session_state.female_df is not No
         # Display in grid layout (3 columns per row)
         num_pyramids_generated = len(st.session_state.generated_pyramids)
         
+        # Number formatting for the data tables is applied by the frontend, no Styler needed
+        table_format = {col: st.column_config.NumberColumn(format='%.3f') for col in ('Male', 'Female', 'Total')}
+        
         for row_start in range(0, num_pyramids_generated, 3):
             row_pyramids = st.session_state.generated_pyramids[row_start:row_start + 3]
             cols = st.columns(len(row_pyramids))
@@ -286,21 +414,20 @@ if st.session_state.male_df is not None and st.session_state.female_df is not No
             for col_idx, pyramid_data in enumerate(row_pyramids):
                 with cols[col_idx]:
                     # Small preview
-                    st.image(fig_to_bytes(pyramid_data['fig']), use_container_width=True)
+                    st.image(pyramid_data['preview_png'], use_container_width=True)
                     
                     # Expander for full view
                     with st.expander(f"🔍 View Full: {pyramid_data['country']} ({pyramid_data['year']})"):
-                        st.pyplot(pyramid_data['fig'])
+                        st.image(pyramid_data['png'], use_container_width=True)
                         
                         if show_tables:
                             st.subheader("📋 Population Data (in thousands)")
-                            # Format the dataframe for better display
-                            styled_table = pyramid_data['table'].style.format({
-                                'Male': '{:.3f}',
-                                'Female': '{:.3f}',
-                                'Total': '{:.3f}'
-                            })
-                            st.dataframe(styled_table, use_container_width=True, height=400)
+                            st.dataframe(
+                                pyramid_data['table'],
+                                column_config=table_format,
+                                use_container_width=True,
+                                height=400
+                            )
         
         # === DOWNLOAD SECTION ===
         st.header("💾 Download Pyramids")
@@ -309,12 +436,11 @@ if st.session_state.male_df is not None and st.session_state.female_df is not No
         
         for idx, pyramid_data in enumerate(st.session_state.generated_pyramids):
             with download_cols[idx % 3]:
-                png_bytes = fig_to_bytes(pyramid_data['fig'])
                 filename = f"pyramid_{pyramid_data['country'].replace(' ', '_')}_{pyramid_data['year']}.png"
                 
                 st.download_button(
                     label=f"⬇️ {pyramid_data['country']} ({pyramid_data['year']})",
-                    data=png_bytes,
+                    data=pyramid_data['png'],
                     file_name=filename,
                     mime="image/png",
                     use_container_width=True,